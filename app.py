@@ -1,10 +1,14 @@
 import os
+import atexit
+import hashlib
+import select
 import time
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from threading import Thread
-from flask import Flask, jsonify, Response
+from threading import Thread, Lock
+from flask import Flask, jsonify, Response, request
 from colorama import Fore, Style, init
 
 # Data sources
@@ -13,7 +17,8 @@ import yfinance as yf
 
 # DB
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import RealDictCursor
 import certifi  # <- important for Railway/SSL
 
 # ================== CONFIG ==================
@@ -29,10 +34,17 @@ BROKERAGE = 40
 TAXES = 9
 SCORE_ENTRY = 0.30
 MIN_BARS_FOR_INDICATORS = 60
+TRADES_PAGE_SIZE = 100   # rows per /api/trades page (keyset on id)
+TRADES_CACHE_TTL = 30    # seconds; backstop, the cache is also invalidated on every saved trade
 
 # ---- DB URL: MUST come from Railway env var (no hardcoded fallback) ----
 DB_URL = os.getenv("DB_URL")  # set this in Railway → Variables
 
+# Pool size per process; keep DB_POOL_MAX x worker processes under the Neon pooler limit
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+
 # ================== GLOBAL STATE ==================
 STATE = {
     "live_price": None,
@@ -45,6 +57,9 @@ STATE = {
     "bars_collected": 0,
 }
 MEM_TRADES = []
+_trades_cache = {}  # "latest" -> (ts, json body, etag): first /api/trades page, polled by the dashboard
+_trades_gen = 0     # bumped on every saved trade; a page read under an older gen is not cached
+_trades_lock = Lock()
 
 DB_ENABLED = False
 POOL = None
@@ -64,9 +79,10 @@ def _mask_url(url: str) -> str:
 
 def _pool_try(dsn: str, note: str):
     """Try to make a pool with strong SSL hints; return (pool|None, error|None, note)."""
+    pool = None
     try:
-        pool = SimpleConnectionPool(
-            1, 5,
+        pool = ThreadedConnectionPool(
+            DB_POOL_MIN, DB_POOL_MAX,
             dsn=dsn,
             connect_timeout=10,
             sslmode="require",
@@ -74,15 +90,18 @@ def _pool_try(dsn: str, note: str):
             keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=5,
             options="-c client_encoding=UTF8",
         )
-        # Sanity check
+        # Sanity check (autocommit: no BEGIN/ROLLBACK roundtrips around the probe)
         conn = pool.getconn()
+        conn.autocommit = True
         cur = conn.cursor()
         cur.execute("SELECT 1;")
         cur.fetchone()
         cur.close()
-        pool.putconn(conn)
+        pool.putconn(conn)  # pooled connections stay in autocommit, see _db_cursor
         return pool, None, note
     except Exception as e:
+        if pool:
+            pool.closeall()  # don't leave a failed attempt's sessions open on Neon
         return None, f"[{note}] {e}", note
 
 def db_init():
@@ -128,9 +147,10 @@ def db_init():
         pool, err, which = _pool_try(dsn, note)
         if pool:
             print(Fore.GREEN + f"✅ Connected using attempt {which}")
-            # ensure table
+            # ensure table (single autocommit statement: 1 roundtrip instead of BEGIN/CREATE/COMMIT)
             try:
                 conn = pool.getconn()
+                conn.autocommit = True
                 cur = conn.cursor()
                 cur.execute("""
                 CREATE TABLE IF NOT EXISTS trades (
@@ -145,7 +165,6 @@ def db_init():
                     reason TEXT
                 );
                 """)
-                conn.commit()
                 cur.close()
                 pool.putconn(conn)
             except Exception as e:
@@ -153,6 +172,7 @@ def db_init():
                 print(Fore.YELLOW + "⚠️  " + STATE["last_error"])
             # success
             globals()["POOL"] = pool
+            atexit.register(pool.closeall)
             globals()["DB_ENABLED"] = True
             STATE["last_error"] = ""
             return
@@ -164,23 +184,79 @@ def db_init():
     STATE["last_error"] = "All DB attempts failed:\n" + "\n".join(errors)
     print(Fore.RED + "❌ " + STATE["last_error"])
 
+def _conn_lost(e):
+    """True if the error means the connection died (not a query/timeout error)."""
+    return (isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            and not isinstance(e, psycopg2.extensions.QueryCanceledError))
+
+# Prefix for every helper query. Sent in the same execute, the two statements run as one
+# implicit transaction, so SET LOCAL applies to the query and resets after it. Not a startup
+# option: the Neon pooler (PgBouncer) rejects untracked startup parameters like this one.
+_STMT_TIMEOUT = f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}; "
+
+@contextmanager
+def _db_cursor(cursor_factory=None):
+    """Pooled autocommit cursor (no BEGIN/COMMIT roundtrips); always return the connection.
+
+    Each helper issues a single execute prefixed with _STMT_TIMEOUT, so one call is one roundtrip.
+    """
+    conn = POOL.getconn()  # connect errors propagate: a down DB is not retried here
+    # Idle connections sit for hours between trades, and the server may have dropped them.
+    # A dropped one is already readable (EOF or a termination notice) before anything is sent,
+    # so swapping it out cannot repeat a statement. The pool keeps at most DB_POOL_MIN idle
+    # connections, so the last swap opens a fresh one.
+    for _ in range(DB_POOL_MIN):
+        if not (conn.closed or select.select([conn], [], [], 0)[0]):
+            break
+        print(Fore.YELLOW + "⚠️  Dropped idle DB connection, taking another.")
+        POOL.putconn(conn, close=True)
+        conn = POOL.getconn()
+    conn.autocommit = True
+    lost = False
+    try:
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
+            yield cur
+    except Exception as e:
+        lost = _conn_lost(e) or bool(conn.closed)
+        raise
+    finally:
+        # a dead connection is closed instead of going back to the idle list
+        POOL.putconn(conn, close=lost)
+
+def _invalidate_trades_cache():
+    global _trades_gen
+    with _trades_lock:
+        _trades_gen += 1
+        _trades_cache.clear()
+
 def db_save_trade(symbol, qty, entry, exitp, gross, net, reason):
+    """Store a closed trade and return the new total profit.
+
+    INSERT and SUM are one statement, sent with the timeout in a single autocommit
+    execute (see _db_cursor): one roundtrip once a pooled connection is in hand.
+    """
     if DB_ENABLED and POOL:
+        # No retry once the INSERT is sent: it may have committed before the connection
+        # died. Dropped idle connections are swapped out before sending, in _db_cursor.
         try:
-            conn = POOL.getconn()
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO trades(symbol, qty, entry, exit, gross, net, reason)
-                VALUES (%s,%s,%s,%s,%s,%s,%s);
-            """, (symbol, qty, entry, exitp, gross, net, reason))
-            conn.commit()
-            cur.close()
-            POOL.putconn(conn)
-            return
+            with _db_cursor() as cur:
+                # SUM runs on the pre-insert snapshot, so add the inserted row's net.
+                cur.execute(_STMT_TIMEOUT + """
+                    WITH ins AS (
+                        INSERT INTO trades(symbol, qty, entry, exit, gross, net, reason)
+                        VALUES (%s,%s,%s,%s,%s,%s,%s)
+                        RETURNING net
+                    )
+                    SELECT (SELECT COALESCE(SUM(net),0) FROM trades) + (SELECT net FROM ins);
+                """, (symbol, qty, entry, exitp, gross, net, reason))
+                total = cur.fetchone()[0]
+            _invalidate_trades_cache()
+            return float(total or 0)
         except Exception as e:
             print(Fore.YELLOW + f"⚠️  DB insert failed, using memory. Reason: {e}")
 
     MEM_TRADES.append({
+        "id": len(MEM_TRADES) + 1,
         "time": datetime.now(),
         "symbol": symbol,
         "qty": qty,
@@ -190,31 +266,45 @@ def db_save_trade(symbol, qty, entry, exitp, gross, net, reason):
         "net": float(net),
         "reason": reason
     })
+    _invalidate_trades_cache()
+    # Don't re-query: if the DB is down too, a memory-only sum would replace the real total
+    return STATE["total_profit"] + float(net)
+
+TRADE_COLS = "id, time, symbol, qty, entry, exit, gross, net, reason"
 
-def db_get_trades():
+def db_get_trades(before_id=None, limit=TRADES_PAGE_SIZE):
+    """Return (rows, fell_back): one page of trades, newest first, as a list of dicts.
+
+    Keyset pagination on id: pass the last id of the previous page as before_id.
+    fell_back is True when the DB read failed and memory rows were returned instead.
+    """
+    fell_back = False
     if DB_ENABLED and POOL:
         try:
-            conn = POOL.getconn()
-            df = pd.read_sql("SELECT * FROM trades ORDER BY time DESC", conn)
-            POOL.putconn(conn)
-            return df
+            with _db_cursor(RealDictCursor) as cur:
+                if before_id is None:
+                    cur.execute(_STMT_TIMEOUT + f"SELECT {TRADE_COLS} FROM trades ORDER BY id DESC LIMIT %s;", (limit,))
+                else:
+                    cur.execute(_STMT_TIMEOUT + f"SELECT {TRADE_COLS} FROM trades WHERE id < %s ORDER BY id DESC LIMIT %s;", (before_id, limit))
+                return cur.fetchall(), False
         except Exception as e:
             print(Fore.YELLOW + f"⚠️  DB read failed, using memory. Reason: {e}")
-    if not MEM_TRADES:
-        return pd.DataFrame(columns=["time","symbol","qty","entry","exit","gross","net","reason"])
-    return pd.DataFrame(MEM_TRADES)
+            fell_back = True
+    # memory ids are 1-based list positions
+    end = len(MEM_TRADES) if before_id is None else max(0, min(before_id - 1, len(MEM_TRADES)))
+    return MEM_TRADES[max(0, end - limit):end][::-1], fell_back
 
 def db_total_profit():
+    """All-time net profit, or None if the DB is enabled but the read failed."""
     if DB_ENABLED and POOL:
         try:
-            conn = POOL.getconn()
-            cur = conn.cursor()
-            cur.execute("SELECT COALESCE(SUM(net),0) FROM trades;")
-            total = cur.fetchone()[0]
-            POOL.putconn(conn)
+            with _db_cursor() as cur:
+                cur.execute(_STMT_TIMEOUT + "SELECT COALESCE(SUM(net),0) FROM trades;")
+                total = cur.fetchone()[0]
             return float(total or 0)
         except Exception as e:
-            print(Fore.YELLOW + f"⚠️  DB sum failed, using memory. Reason: {e}")
+            print(Fore.YELLOW + f"⚠️  DB sum failed, will retry next tick. Reason: {e}")
+            return None
     return float(sum(t["net"] for t in MEM_TRADES))
 
 # ================== PRICE FETCHER ==================
@@ -289,6 +379,8 @@ def trading_bot():
     print(Fore.YELLOW + "=" * 80)
 
     db_init()
+    # Read the running total once it succeeds; after that db_save_trade returns it on each exit
+    total_synced = False
 
     position = None
     closes = []
@@ -296,6 +388,12 @@ def trading_bot():
 
     while True:
         try:
+            if not total_synced:
+                total = db_total_profit()
+                if total is not None:
+                    STATE["total_profit"] = total
+                    total_synced = True
+
             price = get_live_price()
             if price is None:
                 STATE["last_error"] = "Price unavailable (both sources)."
@@ -351,16 +449,12 @@ def trading_bot():
                     net = gross - fees
 
                     STATE["daily_profit"] += net
-                    total = db_total_profit()
-                    STATE["total_profit"] = total + net
-
-                    db_save_trade(SYMBOL, position["qty"], position["entry"], price, gross, net, exit_reason)
+                    STATE["total_profit"] = db_save_trade(SYMBOL, position["qty"], position["entry"], price, gross, net, exit_reason)
 
                     print((Fore.RED if net < 0 else Fore.GREEN) + f"🔚 EXIT: {exit_reason} @ ₹{price:.2f} | Net ₹{net:.2f} (gross {gross:.2f}, fees {fees:.2f})")
                     position = None
                     STATE["position"] = None
 
-            STATE["total_profit"] = db_total_profit()
             print(
                 Fore.WHITE + f"⏰ {datetime.now().strftime('%H:%M:%S')} | "
                 f"💰 Price ₹{price:.2f} | "
@@ -398,14 +492,31 @@ def api_status():
 
 @app.route("/api/trades")
 def api_trades():
-    df = db_get_trades()
-    if not df.empty and not isinstance(df.iloc[0]["time"], str):
-        df["time"] = df["time"].astype(str)
-    return jsonify(df.to_dict(orient="records"))
-
-@app.route("/")
-def dashboard():
-    html = f"""
+    before = request.args.get("before", type=int)
+    if before is None and "before" in request.args:
+        return jsonify({"error": "before must be an integer trade id"}), 400
+    cached = _trades_cache.get("latest") if before is None else None
+    if cached and time.time() - cached[0] < TRADES_CACHE_TTL:
+        _, body, etag = cached
+    else:
+        gen = _trades_gen
+        rows, fell_back = db_get_trades(before_id=before)
+        trades = [{**t, "time": str(t["time"])} for t in rows]
+        body = app.json.dumps(trades)
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        # Skip caching fallback pages, and pages a trade saved mid-read may have made stale
+        if before is None and not fell_back:
+            with _trades_lock:
+                if gen == _trades_gen:
+                    _trades_cache["latest"] = (time.time(), body, etag)
+    resp = Response(body, mimetype="application/json")
+    # Pollers revalidate with If-None-Match and get a bodiless 304 until a trade lands
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+# Static page: the markup has no server-side values, so it is built (and encoded) once at import
+DASHBOARD_HTML = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -413,20 +524,21 @@ def dashboard():
   <title>🚀 ITC Algo Dashboard</title>
   <meta name="viewport" content="width=device-width, initial-scale=1"/>
   <style>
-    body {{ background:#0b0b0b; color:#eee; font-family:Arial, sans-serif; margin:0; padding:20px; }}
-    h1 {{ color:#00ff9f; }}
-    .cards {{ display:grid; grid-template-columns:repeat(4,1fr); gap:12px; margin-bottom:16px; }}
-    .card {{ background:#161616; border-radius:12px; padding:14px; box-shadow:0 0 0 1px #222; }}
-    .label {{ color:#aaa; font-size:12px; }}
-    .value {{ font-size:22px; margin-top:4px; }}
-    .gain {{ color:#00ff9f; }}
-    .loss {{ color:#ff5a5a; }}
-    table {{ width:100%; border-collapse:collapse; margin-top:12px; }}
-    th,td {{ border-bottom:1px solid #222; padding:8px; text-align:left; }}
-    th {{ color:#00ff9f; }}
-    .small {{ font-size:12px; color:#aaa; }}
-    @media (max-width:900px) {{ .cards {{ grid-template-columns:1fr 1fr; }} }}
-    @media (max-width:600px) {{ .cards {{ grid-template-columns:1fr; }} }}
+    body { background:#0b0b0b; color:#eee; font-family:Arial, sans-serif; margin:0; padding:20px; }
+    h1 { color:#00ff9f; }
+    .cards { display:grid; grid-template-columns:repeat(4,1fr); gap:12px; margin-bottom:16px; }
+    .card { background:#161616; border-radius:12px; padding:14px; box-shadow:0 0 0 1px #222; }
+    .label { color:#aaa; font-size:12px; }
+    .value { font-size:22px; margin-top:4px; }
+    .gain { color:#00ff9f; }
+    .loss { color:#ff5a5a; }
+    table { width:100%; border-collapse:collapse; margin-top:12px; }
+    th,td { border-bottom:1px solid #222; padding:8px; text-align:left; }
+    th { color:#00ff9f; }
+    .small { font-size:12px; color:#aaa; }
+    button { background:#0b0b0b; color:#00ff9f; border:1px solid #222; border-radius:8px; padding:6px 12px; margin-top:10px; cursor:pointer; }
+    @media (max-width:900px) { .cards { grid-template-columns:1fr 1fr; } }
+    @media (max-width:600px) { .cards { grid-template-columns:1fr; } }
   </style>
 </head>
 <body>
@@ -449,13 +561,32 @@ def dashboard():
       <thead><tr><th>Time</th><th>Qty</th><th>Entry</th><th>Exit</th><th>Net</th><th>Reason</th></tr></thead>
       <tbody></tbody>
     </table>
+    <button id="older" style="display:none" onclick="pages++; refresh();">Older trades</button>
   </div>
 
 <script>
-async function refresh() {{
-  try {{
-    const s = await fetch('/api/status').then(r => r.json());
-    const t = await fetch('/api/trades').then(r => r.json());
+const PAGE_SIZE = __TRADES_PAGE_SIZE__;
+let pages = 1;  // pages of trades shown; each older page follows the last id of the one before
+
+async function loadTrades() {
+  let rows = [], before = null, more = false;
+  for (let i = 0; i < pages; i++) {
+    const page = await fetch('/api/trades' + (before ? '?before=' + before : '')).then(r => r.json());
+    rows = rows.concat(page);
+    more = page.length === PAGE_SIZE;
+    if (!more) break;
+    before = page[page.length - 1].id;
+  }
+  document.getElementById('older').style.display = more ? '' : 'none';
+  return rows;
+}
+
+async function refresh() {
+  try {
+    const [s, t] = await Promise.all([
+      fetch('/api/status').then(r => r.json()),
+      loadTrades(),
+    ]);
 
     document.getElementById('info').textContent = 'Last update: ' + s.time + (s.error ? ' | ⚠️ ' + s.error : '');
     document.getElementById('price').textContent = s.price ? '₹' + s.price.toFixed(2) : 'Fetching...';
@@ -471,29 +602,39 @@ async function refresh() {{
 
     const tbody = document.querySelector('#table tbody');
     tbody.innerHTML = '';
-    for (const row of t) {{
+    for (const row of t) {
       const tr = document.createElement('tr');
       const net = parseFloat(row.net);
       tr.innerHTML = `
-        <td>${{row.time}}</td>
-        <td>${{row.qty}}</td>
-        <td>₹${{parseFloat(row.entry).toFixed(2)}}</td>
-        <td>₹${{parseFloat(row.exit).toFixed(2)}}</td>
-        <td class="${{net>=0?'gain':'loss'}}">₹${{net.toFixed(2)}}</td>
-        <td>${{row.reason}}</td>`;
+        <td>${row.time}</td>
+        <td>${row.qty}</td>
+        <td>₹${parseFloat(row.entry).toFixed(2)}</td>
+        <td>₹${parseFloat(row.exit).toFixed(2)}</td>
+        <td class="${net>=0?'gain':'loss'}">₹${net.toFixed(2)}</td>
+        <td>${row.reason}</td>`;
       tbody.appendChild(tr);
-    }}
-  }} catch (e) {{
+    }
+  } catch (e) {
     document.getElementById('info').textContent = 'Error updating: ' + e;
-  }}
-}}
+  }
+}
 setInterval(refresh, 5000);
 refresh();
 </script>
 </body>
 </html>
 """
-    return Response(html, mimetype="text/html")
+DASHBOARD_HTML = DASHBOARD_HTML.replace("__TRADES_PAGE_SIZE__", str(TRADES_PAGE_SIZE))
+DASHBOARD_BYTES = DASHBOARD_HTML.encode("utf-8")
+DASHBOARD_ETAG = hashlib.sha1(DASHBOARD_BYTES).hexdigest()
+
+@app.route("/")
+def dashboard():
+    resp = Response(DASHBOARD_BYTES, mimetype="text/html")
+    # Revalidate on each load (a deploy changes the page); unchanged pages get a bodiless 304
+    resp.set_etag(DASHBOARD_ETAG)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
 
 # ================== RUN BOTH ==================
 if __name__ == "__main__":